@@ -8,6 +8,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Все значения окружения читаются один раз при импорте модуля;
+# остальной код обращается только к константам ниже, а не к os.environ.
+
 # Logger
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +26,11 @@ if not TELEGRAM_TOKEN or not NOTIFY_CHAT_ID:
     logger.error("TELEGRAM_TOKEN и NOTIFY_CHAT_ID должны быть установлены в окружении")
     raise ValueError("Отсутствуют обязательные переменные окружения")
 
+# Webhook: если WEBHOOK_URL не задан, бот получает обновления через long polling
+WEBHOOK_URL: str = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PORT: int = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET: str | None = os.environ.get("WEBHOOK_SECRET") or None
+
 # Google Calendar
 TOKENS_PATH: str = os.environ.get("TOKENS_PATH", "/app/tokens")
 RAW_CALENDAR_TOKENS: str = os.environ.get("CALENDAR_TOKENS", "{}")
@@ -31,7 +39,10 @@ CALENDAR_TOKENS: dict = json.loads(RAW_CALENDAR_TOKENS)
 # Scheduler / timing settings
 AHEAD_HOUR: int = int(os.environ.get("AHEAD_HOUR", "2"))
 BUTTON_TTL: int = int(os.environ.get("BUTTON_TTL", "30"))
-NOTIFY_INTERVALS = [int(x) for x in os.getenv("NOTIFY_INTERVALS", "60,30,15,10,5,0").split(",")]
+# интервалы уведомлений в минутах, отсортированы по возрастанию (для bisect)
+NOTIFY_INTERVALS: tuple[int, ...] = tuple(
+    sorted(int(x) for x in os.environ.get("NOTIFY_INTERVALS", "60,30,15,10,5,0").split(","))
+)
 
 # Timezone
 TIMEZONE: str = os.environ.get("TIMEZONE", "Europe/Moscow")
@@ -52,8 +63,13 @@ DATABASE_URL: str = os.environ.get(
     f"postgresql+psycopg2://{DB_URL}",
 )
 
+# SQLAlchemy connection pool
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", "25"))
+DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", "25"))
+DB_POOL_RECYCLE: int = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+
 # Google API scopes
 SCOPES: list[str] = ["https://www.googleapis.com/auth/calendar.readonly"]
 
 # RU weekday
-WEEKDAY = {0: "Пн", 1: "Вт", 2: "Ср", 3: "Чт", 4: "Пт", 5: "Сб", 6: "Вс"}
+WEEKDAY = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
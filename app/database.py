@@ -4,19 +4,44 @@ from enum import Enum
 
 from sqlalchemy import (
     Column,
+    Connection,
     DateTime,
     Enum as SAEnum,
+    Index,
     Integer,
-    String,
+    LargeBinary,
     Text,
     create_engine,
+    text,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session, declarative_base, sessionmaker
 
-from config import DATABASE_URL, TZINFO, logger
+from config import (
+    DATABASE_URL,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    logger,
+)
+
+CLEANUP_BATCH_SIZE = 1000
+CLEANUP_INTERVAL = 7 * 24 * 60 * 60
+INSERT_BATCH_SIZE = 500
+
+shutdown_event = asyncio.Event()
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, future=True, echo=False)
+engine = create_engine(
+    DATABASE_URL,
+    future=True,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_use_lifo=True,
+)
 SessionLocal = sessionmaker(
     bind=engine,
     expire_on_commit=False,
@@ -37,21 +62,33 @@ class SeenEvent(Base):
     Модель для хранения информации о событиях и статусе уведомлений.
 
     Attributes:
-        event_id (str): Уникальный идентификатор события.
+        event_id (bytes): Уникальный идентификатор события — 8 байт хэша (в hex это ev_hash).
         start (datetime): Время начала события.
-        notified_at (datetime): Время, когда было отправлено уведомление.
-        last_point (int, optional): Последняя точка уведомления в минутах до события, для которой уже отправлено уведомление.
-        confirmed (bool): Статус подтверждения события. True, если пользователь подтвердил событие.
+        state (EventState): Текущее состояние уведомлений о событии.
+        message_id (int, optional): ID последнего сообщения о событии в Telegram.
+        message_template (str): Текст события для сообщений (без заголовка статуса).
+        next_notify_at (datetime, optional): Время напоминания, выбранное пользователем.
+        buttons_expire_at (datetime, optional): Время, после которого у сообщения восстанавливаются исходные кнопки.
     """
 
     __tablename__ = "seen_events"
-
-    event_id = Column(String, primary_key=True)
-    start = Column(DateTime(timezone=True), nullable=False)
-    state = Column(SAEnum(EventState), nullable=False, default=EventState.NEW)
+    __table_args__ = (
+        Index("ix_seen_state_next", "state", "next_notify_at"),
+        # SAEnum хранит в БД имена членов EventState, а не их значения
+        Index(
+            "ix_seen_pending",
+            "next_notify_at",
+            postgresql_where=text("state IN ('NEW', 'ANNOUNCED', 'WAITING')"),
+        ),
+    )
+
+    event_id = Column(LargeBinary(8), primary_key=True)
+    start = Column(DateTime(timezone=True), nullable=False, index=True)
+    state = Column(SAEnum(EventState), nullable=False, server_default=EventState.NEW.name)
     message_id = Column(Integer, nullable=True)
     message_template = Column(Text, nullable=False)
     next_notify_at = Column(DateTime(timezone=True), nullable=True)
+    buttons_expire_at = Column(DateTime(timezone=True), nullable=True, index=True)
 
 
 def init_db():
@@ -60,36 +97,110 @@ def init_db():
     """
     logger.info("Инициализация базы данных...")
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _migrate_seen_events(conn)
+    # create_all не добавляет новые индексы к уже существующим таблицам
+    for index in SeenEvent.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
     logger.info("База данных готова.")
 
 
+def _migrate_seen_events(conn: Connection) -> None:
+    """
+    Приводит существующую таблицу seen_events к текущей модели.
+    create_all не меняет уже созданные таблицы, поэтому изменения схемы применяются явно.
+
+    :param conn: соединение с БД в открытой транзакции
+    """
+    conn.execute(text(f"ALTER TABLE seen_events ALTER COLUMN state SET DEFAULT '{EventState.NEW.name}'"))
+    conn.execute(text("ALTER TABLE seen_events ADD COLUMN IF NOT EXISTS buttons_expire_at TIMESTAMP WITH TIME ZONE"))
+
+    # раньше event_id хранился строкой из 16 hex-символов
+    event_id_type = conn.execute(
+        text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'seen_events' AND column_name = 'event_id'"
+        )
+    ).scalar()
+    if event_id_type != "bytea":
+        logger.info("Миграция seen_events.event_id в bytea...")
+        conn.execute(text("ALTER TABLE seen_events ALTER COLUMN event_id TYPE bytea USING decode(event_id, 'hex')"))
+
+
+def insert_new_events(session: Session, rows: list[dict]) -> None:
+    """
+    Добавляет события, которых ещё нет в БД, через INSERT ... ON CONFLICT DO NOTHING.
+    Уже существующие записи (и их состояние) не изменяются.
+
+    :param session: SQLAlchemy сессия
+    :param rows: словари с полями SeenEvent
+    """
+    for i in range(0, len(rows), INSERT_BATCH_SIZE):
+        stmt = pg_insert(SeenEvent).values(rows[i : i + INSERT_BATCH_SIZE])
+        session.execute(stmt.on_conflict_do_nothing(index_elements=[SeenEvent.event_id]))
+
+
 def clean_old_events(session: Session) -> int:
     """
     Удаляет события, которые прошли более недели назад.
+    Удаление выполняется пачками по CLEANUP_BATCH_SIZE записей без загрузки ORM-объектов.
     """
-    now = dt.datetime.now(TZINFO)
+    now = dt.datetime.now(dt.timezone.utc)
     threshold = now - dt.timedelta(weeks=1)
 
-    old_events = session.query(SeenEvent).filter(SeenEvent.start < threshold).all()
-    deleted_count = len(old_events)
+    deleted_count = 0
+    while True:
+        ids = [
+            row.event_id
+            for row in session.query(SeenEvent.event_id)
+            .filter(SeenEvent.start < threshold)
+            .limit(CLEANUP_BATCH_SIZE)
+        ]
+        if not ids:
+            break
+
+        deleted_count += (
+            session.query(SeenEvent)
+            .filter(SeenEvent.event_id.in_(ids))
+            .delete(synchronize_session=False)
+        )
+        session.commit()
 
-    for ev in old_events:
-        session.delete(ev)
     if deleted_count:
-        session.commit()
         logger.info(f"Очистка БД: удалено {deleted_count} старых событий")
     return deleted_count
 
 
+def _cleanup_once() -> int:
+    """
+    Открывает сессию и выполняет очистку старых событий.
+    Вызывается в отдельном потоке, чтобы не блокировать event loop.
+    """
+    session = SessionLocal()
+    try:
+        return clean_old_events(session)
+    finally:
+        session.close()
+
+
 async def weekly_cleanup():
     """
     Периодическая асинхронная очистка старых событий раз в неделю.
     """
     while True:
-        session = SessionLocal()
+        deleted = await asyncio.to_thread(_cleanup_once)
+        logger.info(f"Еженедельная очистка: удалено {deleted} старых событий")
         try:
-            deleted = clean_old_events(session)
-            logger.info(f"Еженедельная очистка: удалено {deleted} старых событий")
-        finally:
-            session.close()
-        await asyncio.sleep(7 * 24 * 60 * 60)
+            await asyncio.wait_for(shutdown_event.wait(), timeout=CLEANUP_INTERVAL)
+            break
+        except asyncio.TimeoutError:
+            continue
+
+
+def close_db() -> None:
+    """
+    Сигнализирует фоновым задачам о завершении работы и закрывает соединения пула.
+    """
+    shutdown_event.set()
+    engine.dispose()
+    logger.info("Соединения с базой данных закрыты.")
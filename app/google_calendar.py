@@ -1,20 +1,64 @@
+import asyncio
 import datetime as dt
+import functools
 import hashlib
-import os
-import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build, Resource
+from googleapiclient.http import HttpRequest, build_http
 from google.auth.transport.requests import Request
 from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
 
-from config import TZINFO, logger
+from config import SCOPES, TZINFO, logger
+from token_storage import is_legacy_token, load_credentials, write_token_file
+
+# Google Calendar API принимает не более 50 запросов в одном batch
+BATCH_LIMIT = 50
+
+# Окно полной синхронизации календаря; внутри него догружаются только изменения (updatedMin)
+SYNC_WINDOW = dt.timedelta(days=1)
+
+# httplib2.Http не потокобезопасен, поэтому у каждого потока свой экземпляр,
+# общий для всех пользователей: соединения с googleapis.com переиспользуются между клиентами
+_thread_local = threading.local()
+
+# Максимальное число одновременных запросов к Google API
+MAX_CONCURRENT_FETCHES = 10
+
+# Отдельный пул потоков для блокирующих запросов к Google API, чтобы не занимать пул asyncio по умолчанию.
+# Размер пула и есть общее ограничение одновременных запросов для проверки событий и команд бота
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES, thread_name_prefix="gcal")
+
+
+def _get_thread_http() -> httplib2.Http:
+    """
+    Возвращает общий HTTP-транспорт текущего потока.
+    build_http задаёт таймаут сокета по умолчанию, чтобы зависший запрос не блокировал поток навсегда.
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_local.http = build_http()
+    return http
+
+
+@functools.lru_cache(maxsize=1)
+def _get_service() -> Resource:
+    """
+    Создаёт сервис Google Calendar API один раз на процесс.
+    Учётные данные передаются в каждый запрос через AuthorizedHttp, поэтому сервис общий.
+    """
+    return build("calendar", "v3", http=build_http(), static_discovery=True)
 
 
 class GoogleCalendarClient:
     """
-    Клиент для работы с Google Calendar API через pickle-токен.
+    Клиент для работы с Google Calendar API через файл с OAuth-токеном.
 
-    Использует pickle-файл с OAuth-токеном, автоматически обновляет access token
+    Использует JSON-файл с OAuth-токеном, автоматически обновляет access token
     и предоставляет методы получения событий за день и неделю.
     """
 
@@ -22,57 +66,76 @@ class GoogleCalendarClient:
         """
         Инициализирует клиента Google Calendar.
 
-        :param token_path: путь к pickle-файлу с OAuth-токеном
+        :param token_path: путь к файлу с OAuth-токеном
         :param tz: таймзона для обработки дат и времени.
         """
         self.token_path: str = token_path
-        self.creds: object | None = None
+        self.creds: Credentials | None = None
         self.service: Resource | None = None
         self.tz: dt.tzinfo = tz
+        self._token_lock = threading.Lock()
+        self._local = threading.local()
+        self._sync_state: dict[str, dict] = {}
         self._authorize()
 
     def _authorize(self) -> None:
         """
-        Загружает токен из pickle-файла и инициализирует Google Calendar API сервис.
+        Загружает токен из файла и инициализирует Google Calendar API сервис.
+        Токены в устаревшем pickle-формате один раз конвертируются в JSON.
         """
         logger.info("Авторизация Google Calendar API...")
-        if not os.path.exists(self.token_path):
+        try:
+            with open(self.token_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
             raise FileNotFoundError(
                 f"Файл токена не найден: {self.token_path}. Создайте его с помощью get_token_pickle.py"
-            )
+            ) from None
 
-        with open(self.token_path, "rb") as f:
-            self.creds = pickle.load(f)
-        self.service = build("calendar", "v3", credentials=self.creds)
+        self.creds = load_credentials(raw, SCOPES)
+        if is_legacy_token(raw):
+            logger.info(f"Токен {self.token_path} в формате pickle, конвертация в JSON...")
+            self._save_creds()
+        self.service = _get_service()
+        self._local = threading.local()
         logger.info("Google Calendar API клиент готов к работе.")
 
     def _save_creds(self) -> None:
         """
-        Сохраняет обновлённые OAuth-учётные данные обратно в pickle-файл.
+        Сохраняет обновлённые OAuth-учётные данные обратно в файл в формате JSON.
         """
-        with open(self.token_path, "wb") as f:
-            pickle.dump(self.creds, f)
+        write_token_file(self.token_path, self.creds.to_json())
 
     def _ensure_token(self) -> None:
         """
         Проверяет валидность OAuth-токена и при необходимости обновляет его.
+        Потокобезопасен: одновременно обновление выполняет только один поток.
         """
-        if self.creds is None:
-            self._authorize()
-            return
+        with self._token_lock:
+            if self.creds is None:
+                self._authorize()
+                return
 
-        if self.creds.expired and self.creds.refresh_token:
-            try:
-                self.creds.refresh(Request())
-                self._save_creds()
-                self.service = build("calendar", "v3", credentials=self.creds)
+            if self.creds.expired and self.creds.refresh_token:
+                try:
+                    self.creds.refresh(Request())
+                    self._save_creds()
+                except RefreshError as e:
+                    logger.error(f"RefreshError: {e}")
+                    raise RuntimeError("NEED_REAUTH")
 
-            except RefreshError as e:
-                logger.error(f"RefreshError: {e}")
+            if not self.creds.valid:
                 raise RuntimeError("NEED_REAUTH")
 
-        if not self.creds.valid:
-            raise RuntimeError("NEED_REAUTH")
+    def _get_http(self) -> AuthorizedHttp:
+        """
+        Возвращает авторизованный HTTP-транспорт пользователя для текущего потока.
+        """
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=_get_thread_http())
+            self._local.http = http
+        return http
 
     def list_events_between(
         self,
@@ -93,37 +156,195 @@ class GoogleCalendarClient:
 
         self._ensure_token()
 
-        time_min = start.astimezone(self.tz).isoformat()
-        time_max = end.astimezone(self.tz).isoformat()
+        events_result = self._build_list_request(calendar_id, start, end).execute(http=self._get_http())
+
+        out = self._parse_events(events_result.get("items", []))
+        logger.info(f"Получено {len(out)} событий из календаря {calendar_id}")
+        return out
+
+    def list_events_between_batch(
+        self,
+        calendar_ids: list[str],
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> dict[str, list[dict]]:
+        """
+        Возвращает события нескольких календарей одним batch-запросом к Google API.
+        События кэшируются по календарям: повторные вызовы запрашивают только изменения
+        с момента прошлой синхронизации (см. _build_sync_request).
+
+        :param calendar_ids: список ID календарей Google.
+        :param start: начало интервала
+        :param end: конец интервала.
+        :return: словарь {ID календаря: список событий}; календари с ошибкой в него не попадают
+        """
+        if not self.service:
+            raise ValueError("Google API клиент не инициализирован")
+
+        self._ensure_token()
+
+        out: dict[str, list[dict]] = {}
+        plans = {cid: self._build_sync_request(cid, start, end) for cid in dict.fromkeys(calendar_ids)}
+
+        def on_response(request_id: str, response: dict, exception: Exception | None) -> None:
+            if exception is not None:
+                logger.error(f"Ошибка получения событий календаря {request_id}: {exception}")
+                self._sync_state.pop(request_id, None)
+                return
+            _, window, incremental = plans[request_id]
+            events = self._apply_sync_response(request_id, response, window, incremental)
+            out[request_id] = self._filter_events(events, start, end)
+            logger.info(f"Получено {len(out[request_id])} событий из календаря {request_id}")
+
+        unique_ids = list(plans)
+        for i in range(0, len(unique_ids), BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for cid in unique_ids[i : i + BATCH_LIMIT]:
+                batch.add(plans[cid][0], request_id=cid)
+            batch.execute(http=self._get_http())
+        return out
+
+    async def list_events_between_batch_async(
+        self,
+        calendar_ids: list[str],
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> dict[str, list[dict]]:
+        """
+        Асинхронная обёртка над list_events_between_batch, выполняющая запрос в пуле потоков Google API.
+
+        :param calendar_ids: список ID календарей Google.
+        :param start: начало интервала
+        :param end: конец интервала.
+        :return: словарь {ID календаря: список событий}
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self.list_events_between_batch, calendar_ids, start, end)
+
+    def _build_list_request(self, calendar_id: str, start: dt.datetime, end: dt.datetime) -> HttpRequest:
+        """
+        Формирует запрос events.list для календаря в заданном диапазоне времени.
 
-        events_result = (
-            self.service.events()
-            .list(
+        :param calendar_id: ID календаря Google.
+        :param start: начало интервала
+        :param end: конец интервала.
+        :return: неисполненный запрос Google API
+        """
+        return self.service.events().list(
+            calendarId=calendar_id,
+            timeMin=self._format_bound(start),
+            timeMax=self._format_bound(end),
+            singleEvents=True,
+            orderBy="startTime",
+        )
+
+    def _build_sync_request(
+        self,
+        calendar_id: str,
+        start: dt.datetime,
+        end: dt.datetime,
+    ) -> tuple[HttpRequest, tuple[dt.datetime, dt.datetime], bool]:
+        """
+        Формирует запрос синхронизации календаря.
+        Если кэш календаря покрывает интервал, запрашиваются только события, изменённые
+        после прошлой синхронизации, иначе — все события за окно длиной SYNC_WINDOW.
+        Верхняя граница в инкрементальном запросе не задаётся, чтобы получить и события,
+        перенесённые за пределы окна.
+
+        :param calendar_id: ID календаря Google.
+        :param start: начало интервала
+        :param end: конец интервала.
+        :return: запрос, окно синхронизации и признак инкрементального запроса
+        """
+        state = self._sync_state.get(calendar_id)
+        if state and state["time_min"] <= start and end <= state["time_max"]:
+            window = (state["time_min"], state["time_max"])
+            request = self.service.events().list(
                 calendarId=calendar_id,
-                timeMin=time_min,
-                timeMax=time_max,
+                timeMin=self._format_bound(window[0]),
+                updatedMin=state["updated"],
                 singleEvents=True,
-                orderBy="startTime",
+                showDeleted=True,
             )
-            .execute()
-        )
+            return request, window, True
+
+        window = (start, max(end, start + SYNC_WINDOW))
+        return self._build_list_request(calendar_id, *window), window, False
+
+    def _apply_sync_response(
+        self,
+        calendar_id: str,
+        response: dict,
+        window: tuple[dt.datetime, dt.datetime],
+        incremental: bool,
+    ) -> dict[str, dict]:
+        """
+        Применяет ответ events.list к кэшу событий календаря.
+
+        :param calendar_id: ID календаря Google.
+        :param response: ответ Google API
+        :param window: окно синхронизации
+        :param incremental: True, если ответ содержит только изменения
+        :return: актуальные события окна синхронизации по их ID в Google
+        """
+        if incremental:
+            state = self._sync_state[calendar_id]
+        else:
+            state = {"time_min": window[0], "time_max": window[1], "events": {}}
+            self._sync_state[calendar_id] = state
+
+        events = state["events"]
+        for e in response.get("items", []):
+            if e.get("status") == "cancelled":
+                events.pop(e["id"], None)
+                continue
+            ev = self._parse_events([e])[0]
+            if ev["end"] > window[0] and ev["start"] < window[1]:
+                events[e["id"]] = ev
+            else:
+                events.pop(e["id"], None)
+
+        state["updated"] = response.get("updated")
+        if not state["updated"] or response.get("nextPageToken"):
+            # изменения нельзя догрузить без отметки времени или полностью — в следующий раз полная синхронизация
+            self._sync_state.pop(calendar_id)
+        return events
+
+    @staticmethod
+    def _filter_events(events: dict[str, dict], start: dt.datetime, end: dt.datetime) -> list[dict]:
+        """
+        Отбирает события, пересекающиеся с интервалом.
+
+        :param events: события по их ID в Google
+        :param start: начало интервала
+        :param end: конец интервала.
+        :return: список событий, отсортированный по времени начала
+        """
+        found = [ev for ev in events.values() if ev["end"] > start and ev["start"] < end]
+        return sorted(found, key=lambda ev: ev["start"])
+
+    def _parse_events(self, items: list[dict]) -> list[dict]:
+        """
+        Преобразует события из ответа Google API во внутренний формат.
 
-        items = events_result.get("items", [])
+        :param items: список событий из ответа events.list
+        :return: список событий с хэшем, названием, началом и концом
+        """
+        parse = self._parse_datetime
         out = []
         for e in items:
-            start_dt = self._parse_datetime(event=e, key="start")
-            end_dt = self._parse_datetime(event=e, key="end")
+            start_dt = parse(event=e, key="start")
+            end_dt = parse(event=e, key="end")
 
-            hash_str = hashlib.md5(f"{e.get('id')}_{start_dt}".encode())
+            ev_hash = hashlib.blake2b(f"{e.get('id')}_{start_dt}".encode(), digest_size=8)
             out.append(
                 {
-                    "ev_hash": hash_str.hexdigest()[:16],
+                    "ev_hash": ev_hash.hexdigest(),
                     "summary": e.get("summary", "(без названия)"),
                     "start": start_dt,
                     "end": end_dt,
                 }
             )
-        logger.info(f"Получено {len(out)} событий из календаря {calendar_id}")
         return out
 
     def get_events_for_day(self, calendar_id: str, day: dt.date) -> list[dict]:
@@ -149,6 +370,31 @@ class GoogleCalendarClient:
         end = (start + dt.timedelta(days=7)).replace(tzinfo=self.tz)
         return self.list_events_between(calendar_id, start, end)
 
+    async def get_events_for_period_async(self, calendar_id: str, date: dt.date, period: str) -> list[dict]:
+        """
+        Асинхронно возвращает события календаря за день или неделю, выполняя запрос в пуле потоков Google API.
+
+        :param calendar_id: ID календаря Google.
+        :param date: дата дня или начала недели
+        :param period: "day" или "week".
+        :return: список событий за период
+        """
+        func = self.get_events_for_day if period == "day" else self.get_events_for_week
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, func, calendar_id, date)
+
+    def _format_bound(self, value: dt.datetime) -> str:
+        """
+        Форматирует границу интервала для запроса к Google API.
+        Пересчёт в таймзону клиента выполняется, только если она отличается.
+
+        :param value: граница интервала
+        :return: строка в формате RFC 3339
+        """
+        if value.tzinfo is not self.tz:
+            value = value.astimezone(self.tz)
+        return value.isoformat()
+
     def _parse_datetime(self, event: dict, key: str) -> dt.datetime:
         """
         Парсит дату и время события Google Calendar.
@@ -158,7 +404,8 @@ class GoogleCalendarClient:
         :param key: ключ 'start'
         :return: время события с таймзоной
         """
-        val = event.get(key, {}).get("dateTime") or event.get(key, {}).get("date")
+        value = event[key]
+        val = value.get("dateTime") or value["date"]
         if len(val) == 10:
             return dt.datetime.fromisoformat(val).replace(tzinfo=self.tz)
         return dt.datetime.fromisoformat(val)
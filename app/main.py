@@ -1,6 +1,7 @@
 import asyncio
+from urllib.parse import urlsplit
 
-from config import CALENDAR_TOKENS, logger
+from config import CALENDAR_TOKENS, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL, logger
 from database import init_db, weekly_cleanup
 from multicalendar import MultiCalendarManager
 from telegram_bot import TelegramBot
@@ -22,7 +23,17 @@ def main():
         logger.info("Запущен планировщик задач Telegram бота")
         loop.create_task(bot.set_bot_commands())
         logger.info("Установлены команды Telegram бота")
-        bot.app.run_polling()
+        if WEBHOOK_URL:
+            logger.info(f"Получение обновлений через webhook {WEBHOOK_URL}")
+            bot.app.run_webhook(
+                listen="0.0.0.0",
+                port=WEBHOOK_PORT,
+                url_path=urlsplit(WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            bot.app.run_polling()
     finally:
         loop.close()
         logger.info("Бот завершил работу.")
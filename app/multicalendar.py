@@ -1,3 +1,5 @@
+import asyncio
+import datetime as dt
 import os
 from typing import Any
 
@@ -40,26 +42,39 @@ class MultiCalendarManager:
         for user, data in configs.items():
             self.clients[user] = self._create_client_for_user(user, data)
 
-    def list_all_events(self, start: str, end: str) -> list[dict[str, Any]]:
+    async def list_all_events(self, start: dt.datetime, end: dt.datetime) -> list[dict[str, Any]]:
         """
         Получает все события всех пользователей в заданном диапазоне дат.
+        Календари одного пользователя запрашиваются одним batch-запросом,
+        запросы разных пользователей выполняются параллельно в пуле потоков Google API
+        (не более google_calendar.MAX_CONCURRENT_FETCHES одновременно).
 
-        :param start: дата начала в формате строки
-        :param end: дата окончания в формате строки
-        :return: список событий всех пользователей
+        :param start: начало интервала
+        :param end: конец интервала
+        :return: список событий всех пользователей без повторов; у события, которое есть
+                 в нескольких календарях, в calendar_names перечислены все эти календари
         """
-        all_events = []
-        for cfg in self.clients.values():
-            client = cfg["client"]
+        configs = list(self.clients.values())
+        results = await asyncio.gather(
+            *[
+                cfg["client"].list_events_between_batch_async(list(cfg["calendars"].values()), start, end)
+                for cfg in configs
+            ],
+            return_exceptions=True,
+        )
+
+        all_events: dict[str, dict[str, Any]] = {}
+        for cfg, result in zip(configs, results):
+            if isinstance(result, BaseException):
+                if isinstance(result, RuntimeError) and str(result) == "NEED_REAUTH":
+                    raise result
+                logger.error(f"Ошибка получения событий календарей {list(cfg['calendars'])}: {result}")
+                continue
             for name, cid in cfg["calendars"].items():
-                try:
-                    events = client.list_events_between(cid, start, end)
-                except RuntimeError as e:
-                    if str(e) == "NEED_REAUTH":
-                        raise
+                for ev in result.get(cid, []):
+                    known = all_events.get(ev["ev_hash"])
+                    if known:
+                        known["calendar_names"].append(name)
                     else:
-                        raise
-                for ev in events:
-                    ev["calendar_name"] = name
-                    all_events.append(ev)
-        return all_events
+                        all_events[ev["ev_hash"]] = {**ev, "calendar_names": [name]}
+        return list(all_events.values())
@@ -1,12 +1,41 @@
+import asyncio
 import datetime as dt
 
+from sqlalchemy import bindparam, func, select, update
 from sqlalchemy.orm import Session
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, error
+from telegram import Message, error
 from telegram.ext import Application
 
 from config import AHEAD_HOUR, TZINFO, logger
-from database import EventState, SeenEvent, SessionLocal
-from utils import EventStatus, build_message, format_event
+from database import EventState, SeenEvent, SessionLocal, insert_new_events
+from utils import EventStatus, build_event_keyboard, build_message, format_event
+
+# Через сколько после next_notify_at проверка событий сама отправит напоминание,
+# если запланированная задача не сработала (например, после перезапуска бота)
+REMINDER_GRACE = dt.timedelta(minutes=1)
+
+_seen_events = SeenEvent.__table__
+
+# Запись результата отправки. Каждый UPDATE меняет только колонки своего перехода и срабатывает,
+# только если запись не изменилась с начала проверки (например, пользователь не нажал кнопку,
+# пока шла отправка)
+_STATE_UPDATE = (
+    update(_seen_events)
+    .where(
+        _seen_events.c.event_id == bindparam("b_event_id"),
+        _seen_events.c.state == bindparam("b_old_state"),
+    )
+    .values(state=bindparam("b_state"), message_id=bindparam("b_message_id"))
+)
+_REMINDER_UPDATE = (
+    update(_seen_events)
+    .where(
+        _seen_events.c.event_id == bindparam("b_event_id"),
+        _seen_events.c.state == EventState.WAITING,
+        _seen_events.c.next_notify_at == bindparam("b_old_next_notify_at"),
+    )
+    .values(next_notify_at=None, message_id=bindparam("b_message_id"))
+)
 
 
 class NotifierWorker:
@@ -18,7 +47,7 @@ class NotifierWorker:
         """
         Инициализация NotifierWorker.
 
-        :param cal_client: экземпляр MultiCalendarManager или любого объекта с методом list_all_events
+        :param cal_client: экземпляр MultiCalendarManager или любого объекта с асинхронным методом list_all_events
         :param bot_app: экземпляр Telegram ApplicationBuilder или объекта с bot.send_message
         :param chat_id: ID чата для отправки уведомлений
         :param scheduler: экземпляр AsyncIOScheduler для планирования задач
@@ -28,38 +57,34 @@ class NotifierWorker:
         self.chat_id = chat_id
         self.scheduler = scheduler
         self.Session = SessionLocal
+        # состояние последней полностью обработанной проверки (см. _is_idle_tick)
+        self._last_event_ids: frozenset[bytes] | None = None
+        self._last_check: dt.datetime | None = None
 
     async def send_event_notification(
         self,
-        session: Session,
-        record: SeenEvent,
+        event_id: str,
+        template: str,
         status: EventStatus,
         with_buttons: bool,
     ) -> Message:
         """
         Отправляет уведомление о событии в Telegram.
 
-        :param session: SQLAlchemy сессия
-        :param record: объект события
+        :param event_id: хэш события (для кнопок)
+        :param template: шаблон текста события
         :param status: статус события
         :param with_buttons: нужно ли добавлять кнопки уведомления/подтверждения
-        :return: отправляет уведомление о событии в Telegram
+        :return: отправленное сообщение; сохранить его message_id должен вызывающий код
         """
         text = build_message(
             status=status,
-            template=record.message_template,
+            template=template,
         )
 
-        keyboard = None
-        if with_buttons:
-            keyboard = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("🔔 Уведомить", callback_data=f"notify:{record.event_id}")],
-                    [InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm:{record.event_id}")],
-                ]
-            )
+        keyboard = build_event_keyboard(event_id) if with_buttons else None
 
-        message = await self.bot_app.bot.send_message(
+        return await self.bot_app.bot.send_message(
             chat_id=self.chat_id,
             text=text,
             reply_markup=keyboard,
@@ -67,11 +92,6 @@ class NotifierWorker:
             disable_web_page_preview=False,
         )
 
-        record.message_id = message.message_id
-        session.flush()
-
-        return message
-
     async def check_and_notify(self) -> None:
         """
         Проверка событий всех календарей и отправка уведомлений о предстоящих событиях.
@@ -83,7 +103,7 @@ class NotifierWorker:
 
         try:
             try:
-                all_events = self.cal_client.list_all_events(now, window_end)
+                all_events = await self.cal_client.list_all_events(now, window_end)
             except RuntimeError as e:
                 if str(e) == "NEED_REAUTH":
                     await self.bot_app.bot.send_message(
@@ -93,6 +113,7 @@ class NotifierWorker:
                     return
                 raise
 
+            events = []
             for ev in all_events:
                 ev_hash = ev.get("ev_hash")
                 if not ev_hash:
@@ -102,76 +123,226 @@ class NotifierWorker:
                 if not start_dt:
                     continue
 
-                start_dt = start_dt.astimezone(TZINFO)
-                calendar_name = ev.get("calendar_name", "")
+                events.append((ev, ev_hash, bytes.fromhex(ev_hash), start_dt))
 
-                record = session.query(SeenEvent).get(ev_hash)
-                event_text = format_event(ev)
-                message_template = f"👤 <u><b>{calendar_name}</b></u>\n{event_text}"
+            event_ids = [event_id for _, _, event_id, _ in events]
+            if self._is_idle_tick(session, events, now):
+                return
 
-                if not record:
-                    record = SeenEvent(
-                        event_id=ev_hash,
-                        start=start_dt,
-                        state=EventState.NEW,
-                        message_template=message_template,
-                    )
-                    session.add(record)
+            records = {
+                row["event_id"]: row
+                for row in session.execute(
+                    select(
+                        SeenEvent.event_id,
+                        SeenEvent.state,
+                        SeenEvent.message_template,
+                        SeenEvent.next_notify_at,
+                    ).where(SeenEvent.event_id.in_(event_ids))
+                ).mappings()
+            }
 
-                if record.state == EventState.CONFIRMED:
+            # текст сообщения формируется только для событий, которых ещё нет в БД
+            rows = []
+            for ev, _, event_id, start_dt in events:
+                if event_id in records:
                     continue
+                calendar_name = ", ".join(ev.get("calendar_names", []))
+                row = {
+                    "event_id": event_id,
+                    "start": start_dt,
+                    "message_template": f"👤 <u><b>{calendar_name}</b></u>\n{format_event(ev, now)}",
+                }
+                rows.append(row)
+                records[event_id] = {**row, "state": EventState.NEW, "next_notify_at": None}
 
-                if start_dt <= now and record.state != EventState.STARTED:
-                    record.state = EventState.STARTED
-                    await self.send_event_notification(
-                        session=session,
-                        record=record,
-                        status=EventStatus.STARTED,
-                        with_buttons=False,
-                    )
+            insert_new_events(session, rows)
+
+            pending: dict[bytes, dict] = {}
+            for _, ev_hash, event_id, start_dt in events:
+                record = records[event_id]
+                if record["state"] == EventState.CONFIRMED:
+                    continue
+
+                state, next_notify_at = record["state"], record["next_notify_at"]
+                if start_dt <= now and state != EventState.STARTED:
+                    status, with_buttons = EventStatus.STARTED, False
+                    values = {"b_old_state": state, "b_state": EventState.STARTED}
+                elif state == EventState.NEW:
+                    status, with_buttons = EventStatus.ANNOUNCED, True
+                    values = {"b_old_state": state, "b_state": EventState.ANNOUNCED}
+                elif state == EventState.WAITING and next_notify_at and now >= next_notify_at + REMINDER_GRACE:
+                    status, with_buttons = EventStatus.SOON, True
+                    values = {"b_old_next_notify_at": next_notify_at}
+                else:
                     continue
 
-                if record.state == EventState.NEW:
-                    record.state = EventState.ANNOUNCED
-                    await self.send_event_notification(
-                        session=session,
-                        record=record,
-                        status=EventStatus.ANNOUNCED,
-                        with_buttons=True,
+                pending[event_id] = {
+                    "ev_hash": ev_hash,
+                    "start": start_dt,
+                    "template": record["message_template"],
+                    "status": status,
+                    "with_buttons": with_buttons,
+                    "values": {"b_event_id": event_id, **values},
+                }
+
+            notifications = list(pending.values())
+            results = await asyncio.gather(
+                *[
+                    self.send_event_notification(
+                        event_id=n["ev_hash"],
+                        template=n["template"],
+                        status=n["status"],
+                        with_buttons=n["with_buttons"],
                     )
+                    for n in notifications
+                ],
+                return_exceptions=True,
+            )
 
+            state_updates, reminder_updates = [], []
+            all_sent = True
+            for n, result in zip(notifications, results):
+                if isinstance(result, Exception):
+                    all_sent = False
+                    # запись не меняется, отправка повторится при следующей проверке
+                    logger.error(f"Ошибка отправки уведомления о событии {n['ev_hash']}: {result}")
+                    continue
+
+                params = {**n["values"], "b_message_id": result.message_id}
+                if n["status"] == EventStatus.SOON:
+                    reminder_updates.append(params)
+                else:
+                    state_updates.append(params)
+                if n["status"] == EventStatus.ANNOUNCED:
                     self.scheduler.add_job(
                         func=self._auto_start_event,
                         trigger="date",
-                        run_date=start_dt,
-                        kwargs={"event_id": ev_hash},
+                        run_date=n["start"],
+                        id=f"start:{n['ev_hash']}",
+                        replace_existing=True,
+                        kwargs={"event_id": n["ev_hash"]},
                     )
 
-                if record.state == EventState.WAITING and record.next_notify_at:
-                    if now >= record.next_notify_at:
-                        await self.send_event_notification(
-                            session=session,
-                            record=record,
-                            status=EventStatus.SOON,
-                            with_buttons=True,
-                        )
-                        record.next_notify_at = None
-
+            if state_updates:
+                session.execute(_STATE_UPDATE, state_updates)
+            if reminder_updates:
+                session.execute(_REMINDER_UPDATE, reminder_updates)
             session.commit()
+
+            # после неудачной отправки следующая проверка не должна быть пропущена
+            self._last_event_ids = frozenset(event_ids) if all_sent else None
+            self._last_check = now
         finally:
             session.close()
             logger.info("Проверка событий завершена.")
 
+    def _is_idle_tick(
+        self,
+        session: Session,
+        events: list[tuple[dict, str, bytes, dt.datetime]],
+        now: dt.datetime,
+    ) -> bool:
+        """
+        Проверяет, что с прошлой проверки ничего не изменилось и обрабатывать нечего:
+        набор событий тот же, ни одно событие не началось и нет просроченных напоминаний.
+
+        :param session: SQLAlchemy сессия
+        :param events: события текущей проверки
+        :param now: текущее время
+        :return: True, если проверку можно пропустить
+        """
+        event_ids = frozenset(event_id for _, _, event_id, _ in events)
+        if self._last_event_ids is None or event_ids != self._last_event_ids:
+            return False
+
+        if any(self._last_check < start_dt <= now for _, _, _, start_dt in events):
+            return False
+
+        next_notify_at = (
+            session.query(func.min(SeenEvent.next_notify_at))
+            .filter(SeenEvent.state == EventState.WAITING, SeenEvent.event_id.in_(event_ids))
+            .scalar()
+        )
+        return next_notify_at is None or now < next_notify_at + REMINDER_GRACE
+
+    def schedule_reminder(self, event_id: str, run_date: dt.datetime) -> None:
+        """
+        Планирует напоминание о событии на указанное время.
+        Повторный вызов для того же события переносит напоминание.
+
+        :param event_id: хэш события
+        :param run_date: время отправки напоминания
+        """
+        self.scheduler.add_job(
+            func=self._send_reminder,
+            trigger="date",
+            run_date=run_date,
+            id=f"remind:{event_id}",
+            replace_existing=True,
+            kwargs={"event_id": event_id},
+        )
+
+    async def _send_reminder(self, event_id: str) -> None:
+        """
+        Отправляет напоминание о событии, выбранное пользователем кнопкой "Уведомить".
+
+        :param event_id: хэш события для поиска в БД.
+        """
+        ev_id = bytes.fromhex(event_id)
+        record = await asyncio.to_thread(self._load_reminder, ev_id)
+        if not record or record["state"] != EventState.WAITING or not record["next_notify_at"]:
+            return
+
+        message = await self.send_event_notification(
+            event_id=event_id,
+            template=record["message_template"],
+            status=EventStatus.SOON,
+            with_buttons=True,
+        )
+        await asyncio.to_thread(self._save_reminder_sent, ev_id, record["next_notify_at"], message.message_id)
+
+    def _load_reminder(self, event_id: bytes) -> dict | None:
+        """
+        Загружает поля записи, нужные для отправки напоминания.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_id: идентификатор события
+        :return: state, message_template и next_notify_at или None, если события нет в БД
+        """
+        with self.Session() as session:
+            return session.execute(
+                select(SeenEvent.state, SeenEvent.message_template, SeenEvent.next_notify_at).where(
+                    SeenEvent.event_id == event_id
+                )
+            ).mappings().one_or_none()
+
+    def _save_reminder_sent(self, event_id: bytes, next_notify_at: dt.datetime, message_id: int) -> None:
+        """
+        Сохраняет отправленное напоминание. Запись не меняется, если пользователь
+        за время отправки выбрал другое время уведомления или подтвердил событие.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_id: идентификатор события
+        :param next_notify_at: время напоминания, прочитанное перед отправкой
+        :param message_id: ID отправленного сообщения
+        """
+        with self.Session() as session:
+            session.execute(
+                _REMINDER_UPDATE,
+                {"b_event_id": event_id, "b_old_next_notify_at": next_notify_at, "b_message_id": message_id},
+            )
+            session.commit()
+
     async def _auto_start_event(self, event_id: str) -> None:
         """
         Автоматическая обработка события при наступлении времени.
         Меняет сообщение на 'Событие началось' и убирает кнопки, если пользователь не взаимодействовал.
 
-        :param event_id: xэш события для поиска в БД.
+        :param event_id: хэш события для поиска в БД.
         """
         session = self.Session()
         try:
-            record = session.query(SeenEvent).get(event_id)
+            record = session.get(SeenEvent, bytes.fromhex(event_id))
             if not record or record.state in {EventState.CONFIRMED, EventState.STARTED}:
                 return
 
@@ -1,8 +1,14 @@
+import asyncio
+import bisect
 import datetime as dt
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from cachetools import TTLCache
+from sqlalchemy import select, update as sa_update
 from telegram import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
+    AIORateLimiter,
+    Application,
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
@@ -18,9 +24,22 @@ from config import (
     TZINFO,
     logger,
 )
-from database import EventState, SeenEvent, SessionLocal
+from database import EventState, SeenEvent, SessionLocal, close_db
 from notifier_worker import NotifierWorker
-from utils import EventStatus, build_message, format_event, get_user_id
+from utils import EventStatus, build_event_keyboard, build_message, format_event, get_user_id
+
+# Подписи кнопок выбора времени уведомления
+NOTIFY_LABELS = {m: "⏱ В момент события" if m == 0 else f"⏱ {m} мин" for m in NOTIFY_INTERVALS}
+
+# Как часто (в секундах) проверять сообщения с истёкшим сроком выбора времени уведомления
+BUTTON_SWEEP_INTERVAL = 10
+# Сколько раз повторять запрос к Telegram после ответа 429 (RetryAfter)
+TELEGRAM_MAX_RETRIES = 3
+# Параметры задач планировщика: пропущенные запуски схлопываются в один,
+# одна задача не выполняется параллельно сама с собой
+SCHEDULER_JOB_DEFAULTS = {"coalesce": True, "max_instances": 1, "misfire_grace_time": 30}
+# Сколько секунд переиспользовать список событий для /today, /tomorrow, /week, /nextweek
+EVENTS_CACHE_TTL = 60
 
 
 class TelegramBot:
@@ -36,6 +55,13 @@ class TelegramBot:
     Также интегрирован с NotifierWorker для автоматических уведомлений.
     """
 
+    COMMANDS = (
+        BotCommand("today", "События на сегодня"),
+        BotCommand("tomorrow", "События на завтра"),
+        BotCommand("week", "События на эту неделю"),
+        BotCommand("nextweek", "События на следующую неделю"),
+    )
+
     def __init__(self, token=TELEGRAM_TOKEN):
         """
         Инициализирует Telegram-бота и регистрирует обработчики команд.
@@ -43,7 +69,14 @@ class TelegramBot:
         :param token: Токен Telegram-бота (по умолчанию из config.TELEGRAM_TOKEN)
         """
         self.token = token
-        self.app = ApplicationBuilder().token(self.token).build()
+        self.app = (
+            ApplicationBuilder()
+            .token(self.token)
+            .rate_limiter(AIORateLimiter(max_retries=TELEGRAM_MAX_RETRIES))
+            .concurrent_updates(True)
+            .post_shutdown(self._on_shutdown)
+            .build()
+        )
         self.app.add_handler(CommandHandler("start", self.start))
         self.app.add_handler(CommandHandler("today", self.today))
         self.app.add_handler(CommandHandler("tomorrow", self.tomorrow))
@@ -55,10 +88,36 @@ class TelegramBot:
         self.app.add_handler(CallbackQueryHandler(self.confirm_callback, pattern=r"^confirm:"))
 
         self.cal_manager = None
+        self._cal_targets: list[tuple[str, object, str]] = []
+        self._events_cache: TTLCache = TTLCache(maxsize=32, ttl=EVENTS_CACHE_TTL)
         self.scheduler = None
         self.notifier = None
+        self._start_text = self._build_start_text()
         logger.info("TelegramBot готов.")
 
+    @staticmethod
+    def _build_start_text() -> str:
+        """
+        Формирует приветственное сообщение для /start. Список календарей берётся из конфигурации
+        и не меняется во время работы, поэтому текст строится один раз.
+
+        :return: HTML-текст приветственного сообщения
+        """
+        calendars_text = "\n".join(f"👤 {', '.join(cfg['calendars'])}" for cfg in CALENDAR_TOKENS.values())
+
+        return (
+            "👋 <b>Привет!</b>\n\n"
+            "📅 Я бот, который отслеживает события Google Calendar.\n\n"
+            f"Подключённые календари:\n<b>{calendars_text}</b>\n\n"
+            "Список команд:\n"
+            "➡️ <b>/today</b> - события на <i>сегодня</i>\n"
+            "➡️ <b>/tomorrow</b> - события на <i>завтра</i>\n"
+            "➡️ <b>/week</b> - события на <i>текущую неделю</i>\n"
+            "➡️ <b>/nextweek</b> - события на <i>следующую неделю</i>\n\n"
+            "⏰ Также отправляю уведомления о предстоящих событиях с кнопками "
+            "«Уведомить» и «Подтвердить» \n"
+        )
+
     def set_calendar_client(self, client_manager) -> None:
         """
         Устанавливает менеджер календарей и настраивает планировщик уведомлений.
@@ -66,9 +125,16 @@ class TelegramBot:
         :param client_manager: Экземпляр менеджера клиентов календарей.
         """
         self.cal_manager = client_manager
-        self.scheduler = AsyncIOScheduler()
+        # (название календаря, клиент, ID календаря) в порядке конфигурации
+        self._cal_targets = [
+            (name, cfg["client"], cid)
+            for cfg in client_manager.clients.values()
+            for name, cid in cfg["calendars"].items()
+        ]
+        self.scheduler = AsyncIOScheduler(job_defaults=SCHEDULER_JOB_DEFAULTS)
         self.notifier = NotifierWorker(client_manager, self.app, NOTIFY_CHAT_ID, self.scheduler)
         self.scheduler.add_job(func=self.notifier.check_and_notify, trigger="cron", minute="*")
+        self.scheduler.add_job(func=self._restore_expired_buttons, trigger="interval", seconds=BUTTON_SWEEP_INTERVAL)
 
         async def start_scheduler():
             self.scheduler.start()
@@ -76,17 +142,19 @@ class TelegramBot:
 
         self.start_scheduler_task = start_scheduler
 
+    async def _on_shutdown(self, app: Application) -> None:
+        """
+        Останавливает планировщик и освобождает соединения с БД при остановке бота.
+        """
+        if self.scheduler and self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        close_db()
+
     async def set_bot_commands(self) -> None:
         """
         Устанавливает список команд для Telegram-бота.
         """
-        commands = [
-            BotCommand("today", "События на сегодня"),
-            BotCommand("tomorrow", "События на завтра"),
-            BotCommand("week", "События на эту неделю"),
-            BotCommand("nextweek", "События на следующую неделю"),
-        ]
-        await self.app.bot.set_my_commands(commands)
+        await self.app.bot.set_my_commands(self.COMMANDS)
         logger.info("Команды бота установлены.")
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -94,31 +162,11 @@ class TelegramBot:
         Обрабатывает команду /start.
         Отправляет приветственное сообщение и список подключённых календарей.
         """
-        calendars_list = []
-        for cfg in CALENDAR_TOKENS.values():
-            names = ", ".join(cfg["calendars"].keys())
-            calendars_list.append(f"👤 {names}")
-
-        calendars_text = "\n".join(calendars_list)
-
-        text = (
-            "👋 <b>Привет!</b>\n\n"
-            "📅 Я бот, который отслеживает события Google Calendar.\n\n"
-            f"Подключённые календари:\n<b>{calendars_text}</b>\n\n"
-            "Список команд:\n"
-            "➡️ <b>/today</b> - события на <i>сегодня</i>\n"
-            "➡️ <b>/tomorrow</b> - события на <i>завтра</i>\n"
-            "➡️ <b>/week</b> - события на <i>текущую неделю</i>\n"
-            "➡️ <b>/nextweek</b> - события на <i>следующую неделю</i>\n\n"
-            "⏰ Также отправляю уведомления о предстоящих событиях с кнопками "
-            "«Уведомить» и «Подтвердить» \n"
-        )
-
         if not update.message:
             return
 
         await update.message.reply_text(
-            text,
+            self._start_text,
             parse_mode="HTML",
             disable_web_page_preview=False,
         )
@@ -133,53 +181,47 @@ class TelegramBot:
             return
 
         await query.answer()
-        ev_hash = query.data.split(":")[1]
+        ev_hash = query.data.removeprefix("notify:")
+        event_id = bytes.fromhex(ev_hash)
 
-        session = SessionLocal()
-        try:
-            record = session.query(SeenEvent).get(ev_hash)
-            if not record:
-                return
+        start = await asyncio.to_thread(self._load_field, event_id, SeenEvent.start)
+        if not start:
+            return
 
-            now = dt.datetime.now(TZINFO)
-            minutes_left = max(int((record.start - now).total_seconds() // 60), 0)
+        now = dt.datetime.now(TZINFO)
+        minutes_left = max(int((start - now).total_seconds() // 60), 0)
 
-            valid_intervals = [m for m in NOTIFY_INTERVALS if m == 0 or m <= minutes_left]
+        # интервалы не больше оставшегося времени, от большего к меньшему
+        valid_intervals = NOTIFY_INTERVALS[: bisect.bisect_right(NOTIFY_INTERVALS, minutes_left)][::-1]
 
-            if not valid_intervals:
-                await query.answer("Событие уже начинается", show_alert=True)
-                return
+        if not valid_intervals:
+            await query.answer("Событие уже начинается", show_alert=True)
+            return
 
-            keyboard = InlineKeyboardMarkup(
+        prefix = "notify_set:" + ev_hash + ":"
+        keyboard = InlineKeyboardMarkup(
+            [
                 [
-                    [
-                        InlineKeyboardButton(
-                            "⏱ В момент события" if m == 0 else f"⏱ {m} мин",
-                            callback_data=f"notify_set:{ev_hash}:{m}",
-                        )
-                    ]
-                    for m in valid_intervals
+                    InlineKeyboardButton(
+                        NOTIFY_LABELS[m],
+                        callback_data=prefix + str(m),
+                    )
                 ]
-            )
-
-            await query.edit_message_reply_markup(reply_markup=keyboard)
+                for m in valid_intervals
+            ]
+        )
 
-            self.scheduler.add_job(
-                func=self._restore_original_buttons,
-                trigger="date",
-                run_date=now + dt.timedelta(seconds=BUTTON_TTL),
-                kwargs={
-                    "event_id": ev_hash,
-                    "message_id": query.message.message_id,
-                },
-            )
+        await query.edit_message_reply_markup(reply_markup=keyboard)
 
-        finally:
-            session.close()
+        await asyncio.to_thread(
+            self._update_record,
+            event_id,
+            buttons_expire_at=now + dt.timedelta(seconds=BUTTON_TTL),
+        )
 
     async def notify_set_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
-        Пользователь выбрал время уведомления — сохраняем next_notify_at.
+        Пользователь выбрал время уведомления — сохраняем next_notify_at и планируем напоминание.
         Обновляет запись в базе данных и изменяет сообщение в чате.
         Кнопки у сообщения убираем.
         """
@@ -189,24 +231,19 @@ class TelegramBot:
 
         await query.answer()
 
-        _, ev_hash, minutes_str = query.data.split(":")
+        ev_hash, _, minutes_str = query.data.removeprefix("notify_set:").partition(":")
+        if not minutes_str:
+            return
         minutes = int(minutes_str)
+        event_id = bytes.fromhex(ev_hash)
 
-        session = SessionLocal()
-        try:
-            record = session.query(SeenEvent).get(ev_hash)
-            if not record:
-                return
-
-            record.next_notify_at = record.start - dt.timedelta(minutes=minutes)
-            record.state = EventState.WAITING
-
-            session.commit()
+        next_notify_at = await asyncio.to_thread(self._set_notify_time, event_id, minutes)
+        if not next_notify_at:
+            return
 
-            await query.edit_message_reply_markup(reply_markup=None)
+        self.notifier.schedule_reminder(ev_hash, next_notify_at)
 
-        finally:
-            session.close()
+        await query.edit_message_reply_markup(reply_markup=None)
 
     async def confirm_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -219,30 +256,76 @@ class TelegramBot:
             return
 
         await query.answer()
-        ev_hash = query.data.split(":")[1]
+        ev_hash = query.data.removeprefix("confirm:")
+        event_id = bytes.fromhex(ev_hash)
 
-        session = SessionLocal()
-        record = session.query(SeenEvent).get(ev_hash)
-        if not record:
+        template = await asyncio.to_thread(self._load_field, event_id, SeenEvent.message_template)
+        if not template:
             return
-        try:
-            record.state = EventState.CONFIRMED
 
-            text = build_message(
-                status=EventStatus.CONFIRMED,
-                template=record.message_template,
-            )
+        text = build_message(
+            status=EventStatus.CONFIRMED,
+            template=template,
+        )
 
-            await query.edit_message_text(
-                text=text,
-                parse_mode="HTML",
-                disable_web_page_preview=False,
-            )
-            await query.edit_message_reply_markup(reply_markup=None)
+        await query.edit_message_text(
+            text=text,
+            parse_mode="HTML",
+            disable_web_page_preview=False,
+        )
+        await query.edit_message_reply_markup(reply_markup=None)
+
+        await asyncio.to_thread(self._update_record, event_id, state=EventState.CONFIRMED)
 
+    @staticmethod
+    def _load_field(event_id: bytes, column):
+        """
+        Загружает одно поле записи о событии, не загружая остальные колонки.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_id: идентификатор события
+        :param column: колонка SeenEvent, например SeenEvent.start
+        :return: значение поля или None, если события нет в БД
+        """
+        with SessionLocal() as session:
+            return session.execute(select(column).where(SeenEvent.event_id == event_id)).scalar_one_or_none()
+
+    @staticmethod
+    def _update_record(event_id: bytes, **values) -> None:
+        """
+        Обновляет поля записи о событии одним UPDATE, без загрузки строки.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_id: идентификатор события
+        :param values: новые значения полей SeenEvent
+        """
+        with SessionLocal() as session:
+            session.execute(sa_update(SeenEvent).where(SeenEvent.event_id == event_id).values(**values))
+            session.commit()
+
+    @staticmethod
+    def _set_notify_time(event_id: bytes, minutes: int) -> dt.datetime | None:
+        """
+        Переводит событие в ожидание напоминания за minutes минут до начала.
+        Время напоминания вычисляется в том же UPDATE, без загрузки строки.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_id: идентификатор события
+        :param minutes: за сколько минут до начала напомнить
+        :return: время напоминания или None, если события нет в БД
+        """
+        with SessionLocal() as session:
+            next_notify_at = session.execute(
+                sa_update(SeenEvent)
+                .where(SeenEvent.event_id == event_id)
+                .values(
+                    next_notify_at=SeenEvent.start - dt.timedelta(minutes=minutes),
+                    state=EventState.WAITING,
+                )
+                .returning(SeenEvent.next_notify_at)
+            ).scalar_one_or_none()
             session.commit()
-        finally:
-            session.close()
+            return next_notify_at
 
     async def today(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Команда /today — показывает события на сегодня."""
@@ -273,7 +356,7 @@ class TelegramBot:
         offset = dt.timedelta(weeks=week_offset)
         start_of_week = now_local - dt.timedelta(days=now_local.weekday())
         day = start_of_week + offset
-        events_dict = self._collect_events_for_period(day, "week")
+        events_dict = await self._collect_events_for_period(day, "week")
         await self._send_events_list(update, label, events_dict)
 
     async def _show_day(self, update: Update, days_offset: int, label: str) -> None:
@@ -287,7 +370,7 @@ class TelegramBot:
             return
         offset = dt.timedelta(days=days_offset)
         day = dt.datetime.now(TZINFO).date() + offset
-        events_dict = self._collect_events_for_period(day, "day")
+        events_dict = await self._collect_events_for_period(day, "day")
         await self._send_events_list(update, label, events_dict)
 
     async def _cal_manager_error(self, update: Update) -> bool:
@@ -304,23 +387,25 @@ class TelegramBot:
                 return True
         return False
 
-    def _collect_events_for_period(self, date: dt.date, period: str) -> dict[str, list[dict]]:
+    async def _collect_events_for_period(self, date: dt.date, period: str) -> dict[str, list[dict]]:
         """
         Собирает события для всех пользователей на указанный день или неделю.
+        Календари запрашиваются параллельно, результат кэшируется на EVENTS_CACHE_TTL секунд.
 
         :param date: Дата (для дня) или первый день недели.
         :param period: "day" или "week".
         :return: Словарь вида {calendar_name: [events]}.
         """
-        events_dict = {}
-        for user, cfg in CALENDAR_TOKENS.items():
-            client = self.cal_manager.clients[user]["client"]
-            for name, cid in cfg["calendars"].items():
-                if period == "day":
-                    evs = client.get_events_for_day(cid, date)
-                else:
-                    evs = client.get_events_for_week(cid, date)
-                events_dict[name] = evs
+        key = (period, date.toordinal())
+        events_dict = self._events_cache.get(key)
+        if events_dict is not None:
+            return events_dict
+
+        results = await asyncio.gather(
+            *[client.get_events_for_period_async(cid, date, period) for _, client, cid in self._cal_targets]
+        )
+        events_dict = {name: evs for (name, _, _), evs in zip(self._cal_targets, results)}
+        self._events_cache[key] = events_dict
         return events_dict
 
     async def _send_events_list(self, update: Update, label: str, events_dict: dict[str, list[dict]]) -> None:
@@ -330,16 +415,16 @@ class TelegramBot:
         :param label: Подпись периода ("сегодня", "на неделю" и т. д.)
         :param events_dict: Словарь событий по календарям.
         """
-        out: list[str] = []
-        header = f"📅 <b>События <u>{label}</u></b>\n"
+        now = dt.datetime.now(TZINFO)
+        parts = [f"📅 <b>События <u>{label}</u></b>"]
         for name, evs in events_dict.items():
             if evs:
-                out.append(f"\n👤 <u><b>{name}</b></u>")
-                out += [format_event(e) for e in evs]
+                parts.append(f"\n👤 <u><b>{name}</b></u>")
+                parts.extend(format_event(e, now) for e in evs)
 
-        if out:
+        if len(parts) > 1:
             await update.message.reply_text(
-                header + "\n".join(out),
+                "\n".join(parts),
                 parse_mode="HTML",
                 disable_web_page_preview=False,
             )
@@ -347,34 +432,66 @@ class TelegramBot:
         else:
             await update.message.reply_text(f"Нет событий {label}.")
 
-    async def _restore_original_buttons(self, event_id: str, message_id: int):
+    async def _restore_expired_buttons(self) -> None:
         """
-         Восстанавливает оригинальные кнопки уведомления и подтверждения, если событие ещё не подтверждено.
-
-        :param event_id: xэш события
-        :param message_id: ID сообщения Telegram
+        Восстанавливает оригинальные кнопки уведомления и подтверждения у сообщений,
+        где пользователь не выбрал время уведомления за BUTTON_TTL секунд.
         """
-        session = SessionLocal()
-        try:
-            record = session.query(SeenEvent).get(event_id)
-            if not record:
-                return
+        now = dt.datetime.now(TZINFO)
+        records = await asyncio.to_thread(self._load_expired_buttons, now)
+        if not records:
+            return
 
+        edits = [
+            self.app.bot.edit_message_reply_markup(
+                chat_id=NOTIFY_CHAT_ID,
+                message_id=message_id,
+                reply_markup=build_event_keyboard(event_id.hex()),
+            )
+            for event_id, message_id, state in records
             # если уже выбрали таймер / подтвердили — не трогаем
-            if record.state != EventState.ANNOUNCED:
-                return
+            if state == EventState.ANNOUNCED and message_id
+        ]
 
-            keyboard = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("🔔 Уведомить", callback_data=f"notify:{event_id}")],
-                    [InlineKeyboardButton("✅ Подтвердить", callback_data=f"confirm:{event_id}")],
-                ]
-            )
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception) and "Message is not modified" not in str(result):
+                logger.error(f"Ошибка восстановления кнопок: {result}")
 
-            await self.bot_app.bot.edit_message_reply_markup(
-                chat_id=NOTIFY_CHAT_ID,
-                message_id=message_id,
-                reply_markup=keyboard,
+        await asyncio.to_thread(self._clear_buttons_expire, [event_id for event_id, _, _ in records], now)
+
+    @staticmethod
+    def _load_expired_buttons(now: dt.datetime) -> list[tuple[bytes, int | None, EventState]]:
+        """
+        Загружает события, у которых истёк срок выбора времени уведомления.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param now: текущее время
+        :return: список (event_id, message_id, state)
+        """
+        with SessionLocal() as session:
+            return [
+                tuple(row)
+                for row in session.execute(
+                    select(SeenEvent.event_id, SeenEvent.message_id, SeenEvent.state).where(
+                        SeenEvent.buttons_expire_at <= now
+                    )
+                )
+            ]
+
+    @staticmethod
+    def _clear_buttons_expire(event_ids: list[bytes], now: dt.datetime) -> None:
+        """
+        Сбрасывает срок выбора времени уведомления одним UPDATE.
+        Срок, продлённый повторным нажатием "Уведомить" после now, не сбрасывается.
+        Блокирующий вызов, выполняется в отдельном потоке.
+
+        :param event_ids: идентификаторы событий
+        :param now: время, на которое загружались истёкшие записи
+        """
+        with SessionLocal() as session:
+            session.execute(
+                sa_update(SeenEvent)
+                .where(SeenEvent.event_id.in_(event_ids), SeenEvent.buttons_expire_at <= now)
+                .values(buttons_expire_at=None)
             )
-        finally:
-            session.close()
+            session.commit()
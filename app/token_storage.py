@@ -0,0 +1,57 @@
+import json
+import os
+import pickle
+import tempfile
+
+from google.oauth2.credentials import Credentials
+
+
+def is_legacy_token(raw: bytes) -> bool:
+    """
+    Проверяет, что токен сохранён в устаревшем pickle-формате, а не в JSON.
+
+    :param raw: содержимое файла токена
+    :return: True для pickle-токена
+    """
+    return not raw.lstrip().startswith(b"{")
+
+
+def load_credentials(raw: bytes, scopes: list[str]) -> Credentials:
+    """
+    Загружает OAuth-учётные данные из JSON-формата google-auth или устаревшего pickle-формата.
+
+    :param raw: содержимое файла токена
+    :param scopes: области доступа Google API
+    :return: учётные данные пользователя
+    """
+    if is_legacy_token(raw):
+        return pickle.loads(raw)
+    return Credentials.from_authorized_user_info(json.loads(raw), scopes)
+
+
+def write_token_file(token_path: str, data: str) -> None:
+    """
+    Атомарно записывает токен в файл: сбой во время записи не оставляет повреждённый файл.
+    Временный файл создаётся с уникальным именем и правами 0600, поэтому одновременные записи
+    не мешают друг другу, а токен не становится доступен другим пользователям.
+
+    :param token_path: путь к файлу токена
+    :param data: JSON токена
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(token_path) or ".",
+        prefix=os.path.basename(token_path) + ".",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, token_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
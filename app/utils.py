@@ -1,8 +1,14 @@
 import datetime as dt
+import functools
 from enum import Enum
 
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
 from config import TZINFO, WEEKDAY
 
+NOTIFY_BUTTON_TEXT = "🔔 Уведомить"
+CONFIRM_BUTTON_TEXT = "✅ Подтвердить"
+
 
 class EventStatus(Enum):
     ANNOUNCED = ("⏰", "Событие")
@@ -10,23 +16,24 @@ class EventStatus(Enum):
     STARTED = ("🆘", "Событие началось")
     CONFIRMED = ("🎯", "Событие подтверждено")
 
-    @property
+    @functools.cached_property
     def header(self) -> str:
         icon, text = self.value
         return f"{icon} <b>{text}</b>"
 
 
-def format_event(ev: dict, name_width: int = 25) -> str:
+def format_event(ev: dict, now: dt.datetime, name_width: int = 25) -> str:
     """
-    Docstring for format_event
+    Формирует строку события для списка событий.
 
-    :param ev: cобытие календаря.
+    :param ev: событие календаря.
+    :param now: текущее время (вычисляется один раз для списка событий)
     :param name_width: максимальное кол-во символов в названии события
     :return: отформатированная строка события с датой, временем и значком.
     """
     start: dt.datetime = ev["start"]
-    start = start.astimezone(TZINFO)
-    now = dt.datetime.now(TZINFO)
+    if start.tzinfo is not TZINFO:
+        start = start.astimezone(TZINFO)
     mark = "☑️" if start < now else "📌"
 
     start_str = start.strftime("%d.%m %H:%M")
@@ -36,22 +43,35 @@ def format_event(ev: dict, name_width: int = 25) -> str:
     if len(summary) > name_width:
         summary = summary[: name_width - 3] + "..."
 
-    summary_padded = summary.ljust(name_width)
-
-    return f"<code>{mark} {start_str} ({weekday_str}) | {summary_padded}</code>"
+    return f"<code>{mark} {start_str} ({weekday_str}) | {summary:<{name_width}}</code>"
 
 
 def build_message(status: EventStatus, template: str) -> str:
     """
     Формирует сообщение Telegram с заголовком статуса события.
 
-    :param status: cтатус события.
+    :param status: статус события.
     :param template: шаблон текста события
     :return: полный текст сообщения
     """
     return f"{status.header}\n\n{template}"
 
 
+def build_event_keyboard(event_id: str) -> InlineKeyboardMarkup:
+    """
+    Формирует кнопки "Уведомить" и "Подтвердить" для сообщения о событии.
+
+    :param event_id: хэш события
+    :return: клавиатура сообщения
+    """
+    return InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton(NOTIFY_BUTTON_TEXT, callback_data="notify:" + event_id)],
+            [InlineKeyboardButton(CONFIRM_BUTTON_TEXT, callback_data="confirm:" + event_id)],
+        ]
+    )
+
+
 def get_user_id(user) -> str:
     """
     Возвращает строковое представление пользователя Telegram.
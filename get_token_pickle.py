@@ -1,51 +1,225 @@
-import os
-import pickle
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import datetime as dt
+import json
+import threading
+from typing import Callable
+from google.oauth2.credentials import Credentials
 from app.config import SCOPES, logger
+from app.token_storage import is_legacy_token, load_credentials, write_token_file
 
+# Токен из кэша используется, пока до истечения его срока остаётся больше этого запаса
+TOKEN_EXPIRY_MARGIN = dt.timedelta(minutes=5)
 
-def create_token(creds_path: str, token_path: str) -> None:
+# Загруженные токены: token_path (или token_store) -> учётные данные
+_TOKEN_CACHE: dict[object, Credentials] = {}
+_cache_lock = threading.Lock()
+# Блокировки загрузки/обновления токена: одновременно токен обновляет только один поток,
+# остальные дожидаются его и берут результат из кэша
+_refresh_locks: dict[object, threading.Lock] = {}
+
+
+def create_token(
+    creds: str | dict,
+    token_path: str | None = None,
+    force_refresh: bool = False,
+    token_store: Callable[[], str | None] | None = None,
+    token_save: Callable[[str], None] | None = None,
+) -> Credentials:
     """
-    Создаёт или обновляет pickle-токен для доступа к Google Calendar API.
+    Создаёт или обновляет токен для доступа к Google Calendar API.
+    Токен сохраняется в JSON-формате google-auth; токен в устаревшем pickle-формате
+    читается и перезаписывается в JSON.
 
     Если файл токена уже существует — выполняется попытка обновить его.
     Если токен недействителен или отсутствует, создаётся новый через OAuth-авторизацию.
+    Вместо файлов можно передать содержимое credentials.json словарём и функции
+    чтения/записи токена (например, для хранения в БД или секрет-хранилище).
+
+    :param creds: путь к credentials.json, выданному Google Cloud Console, или его содержимое
+    :param token_path: путь для сохранения итогового токена
+    :param force_refresh: не использовать кэш и обновить токен, даже если он ещё действителен
+    :param token_store: функция, возвращающая JSON токена или None (вместо чтения token_path)
+    :param token_save: функция, сохраняющая JSON токена (вместо записи в token_path)
+    :return: действительные учётные данные
+    """
+    if token_path is None and (token_store is None or token_save is None):
+        raise ValueError("Нужно указать token_path или token_store и token_save")
+
+    key = token_path if token_path is not None else token_store
+    if not force_refresh:
+        cached = _get_cached(key)
+        if cached:
+            return cached
+
+    with _cache_lock:
+        refresh_lock = _refresh_locks.setdefault(key, threading.Lock())
+
+    with refresh_lock:
+        # пока ждали блокировку, токен мог обновить другой поток
+        if not force_refresh:
+            cached = _get_cached(key)
+            if cached:
+                return cached
+
+        user_creds = _load_or_refresh(creds, token_path, force_refresh, token_store, token_save)
+        with _cache_lock:
+            _TOKEN_CACHE[key] = user_creds
+    return user_creds
+
+
+def get_access_token(creds: str | dict, token_path: str) -> str:
+    """
+    Возвращает строку access-токена для запросов к API.
+    Если сохранённый токен ещё не истекает, он берётся прямо из JSON без создания Credentials;
+    иначе токен загружается и обновляется через create_token.
+
+    :param creds: путь к credentials.json или его содержимое (нужны только для обновления)
+    :param token_path: путь к файлу токена
+    :return: access-токен
+    """
+    cached = _get_cached(token_path)
+    if cached:
+        return cached.token
+
+    try:
+        with open(token_path, "rb") as token:
+            data = json.loads(token.read())
+        expiry = dt.datetime.fromisoformat(data["expiry"])
+        if expiry.tzinfo is None:
+            expiry = expiry.replace(tzinfo=dt.timezone.utc)
+        if data["token"] and expiry - dt.datetime.now(dt.timezone.utc) > TOKEN_EXPIRY_MARGIN:
+            return data["token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        # нет файла, pickle-формат или неполный JSON — идём полным путём
+        pass
+
+    return create_token(creds, token_path).token
+
+
+def _get_cached(key: object) -> Credentials | None:
+    """
+    Возвращает токен из кэша, если он ещё не требует обновления.
+
+    :param key: token_path или token_store
+    :return: учётные данные или None
+    """
+    with _cache_lock:
+        cached = _TOKEN_CACHE.get(key)
+    return cached if cached and _is_fresh(cached) else None
+
+
+def _load_or_refresh(
+    client_config: str | dict,
+    token_path: str | None,
+    force_refresh: bool,
+    token_store: Callable[[], str | None] | None,
+    token_save: Callable[[str], None] | None,
+) -> Credentials:
+    """
+    Загружает токен, при необходимости обновляет его или получает новый через OAuth.
 
-    :param creds_path: путь к credentials.json, выданному Google Cloud Console
-    :param token_path: путь для сохранения итогового token.pickle
+    :param client_config: путь к credentials.json или его содержимое
+    :param token_path: путь к файлу токена
+    :param force_refresh: обновить токен, даже если он ещё действителен
+    :param token_store: функция чтения токена вместо файла
+    :param token_save: функция записи токена вместо файла
+    :return: действительные учётные данные
     """
     logger.info("▶️ Запуск генерации токена Google Calendar...")
     creds = None
-    if os.path.exists(token_path):
-        logger.info(f"✅ Найден существующий токен: {token_path}")
-        with open(token_path, "rb") as token:
-            creds = pickle.load(token)
+    legacy = False
+    raw = _read_token(token_path, token_store)
+
+    if raw is not None:
+        logger.info(f"✅ Найден существующий токен: {token_path or 'token_store'}")
+        legacy = is_legacy_token(raw)
+        if legacy:
+            logger.info("🔁 Токен в формате pickle, будет сохранён в JSON")
+        creds = load_credentials(raw, SCOPES)
+
+    if not creds or not creds.valid or force_refresh:
+        if creds and creds.refresh_token and (creds.expired or force_refresh):
+            # транспорт requests и OAuth-flow нужны только при обновлении/получении токена
+            from google.auth.transport.requests import Request
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
             logger.info("🔄 Обновление устаревшего токена...")
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             logger.info("🌐 Создание нового токена через OAuth...")
-            flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
+            if isinstance(client_config, dict):
+                flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(client_config, SCOPES)
             creds = flow.run_local_server(port=0, access_type="offline", include_granted_scopes="true")
 
-        with open(token_path, "wb") as token:
-            pickle.dump(creds, token)
-            logger.info(f"✅ Токен успешно сохранён: {token_path}")
+        _save_token(creds, token_path, token_save)
+    elif legacy:
+        _save_token(creds, token_path, token_save)
     else:
         logger.info("✅ Существующий токен действителен — обновление не требуется.")
     logger.info(creds.refresh_token)
     logger.info("🏁 Генерация токена завершена.")
+    return creds
+
+
+def _is_fresh(creds: Credentials) -> bool:
+    """
+    Проверяет, что токен действителен и не истечёт в ближайшие TOKEN_EXPIRY_MARGIN.
+
+    :param creds: учётные данные пользователя
+    :return: True, если токен можно использовать без обновления
+    """
+    if not creds.valid:
+        return False
+    # expiry в google-auth хранится как naive UTC
+    return creds.expiry is None or creds.expiry - dt.datetime.utcnow() > TOKEN_EXPIRY_MARGIN
+
+
+def _read_token(token_path: str | None, token_store: Callable[[], str | None] | None) -> bytes | None:
+    """
+    Читает сохранённый токен из token_store или из файла.
+
+    :param token_path: путь к файлу токена
+    :param token_store: функция чтения токена вместо файла
+    :return: содержимое токена или None, если токена нет
+    """
+    if token_store is not None:
+        data = token_store()
+        return data.encode("utf-8") if data else None
+
+    try:
+        with open(token_path, "rb") as token:
+            return token.read()
+    except FileNotFoundError:
+        return None
+
+
+def _save_token(creds: Credentials, token_path: str | None, token_save: Callable[[str], None] | None) -> None:
+    """
+    Сохраняет OAuth-учётные данные в JSON-формате google-auth через token_save или в файл.
+    Файл записывается атомарно (см. write_token_file).
+
+    :param creds: учётные данные пользователя
+    :param token_path: путь к файлу токена
+    :param token_save: функция записи токена вместо файла
+    """
+    if token_save is not None:
+        token_save(creds.to_json())
+        logger.info("✅ Токен успешно сохранён через token_save")
+        return
+
+    write_token_file(token_path, creds.to_json())
+    logger.info(f"✅ Токен успешно сохранён: {token_path}")
 
 
 if __name__ == "__main__":
     import argparse
 
-    parser = argparse.ArgumentParser(description="Создание token.pickle для Google Calendar API")
+    parser = argparse.ArgumentParser(description="Создание токена Google Calendar API")
     parser.add_argument("--creds", required=True, help="Путь до credentials.json")
-    parser.add_argument("--token", default="token.pickle", help="Путь, куда сохранить token.pickle")
+    parser.add_argument("--token", default="token.pickle", help="Путь, куда сохранить токен (JSON)")
+    parser.add_argument("--force-refresh", action="store_true", help="Обновить токен, даже если он действителен")
 
     args = parser.parse_args()
-    create_token(args.creds, args.token)
+    create_token(args.creds, args.token, force_refresh=args.force_refresh)